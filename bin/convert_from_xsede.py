@@ -6,13 +6,18 @@
 #  Storing them in the new ACCESS-CI news repository
 #
 import argparse
-from collections import Counter
+from collections import Counter, defaultdict, deque
 from datetime import datetime, timezone, tzinfo, timedelta
 from django.utils.dateparse import parse_datetime
+import gzip
+import hashlib
 import http.client as httplib
+import ijson
 import json
 import logging
 import logging.handlers
+import math
+import orjson
 import os
 from pid import PidFile
 import pwd
@@ -24,16 +29,24 @@ import ssl
 from time import sleep
 import traceback
 from urllib.parse import urlparse
-import pytz
-Central_TZ = pytz.timezone('US/Central')
+import zlib
+from zoneinfo import ZoneInfo
+Central_TZ = ZoneInfo('America/Chicago')    # US/Central
+# Expected daemon stdout contents, see SaveDaemonStdOut
+Started_RE = re.compile(r'^started with pid \d+$')
+Empty_RE = re.compile(r'^$')
 
 import django
 django.setup()
-from django.db import DataError, IntegrityError
+from django.db import connection, DataError, IntegrityError, transaction
 from django.conf import settings
 from django.utils.dateparse import parse_datetime
 from news.models import *
 from warehouse_state.process import ProcessingActivity
+try:    # Optional Postgres COPY based loader
+    from django_bulk_load import bulk_insert_models, bulk_update_models
+except ImportError:
+    bulk_insert_models = bulk_update_models = None
 
 import pdb
 
@@ -41,6 +54,17 @@ import pdb
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+# File-like wrapper that digests everything read through it
+class DigestReader():
+    def __init__(self, file):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hash.update(data)
+        return(data)
+
 class Router():
     def __init__(self):
         parser = argparse.ArgumentParser(epilog='File SRC|DEST syntax: file:<file path and name')
@@ -119,6 +143,13 @@ class Router():
         self.peak_sleep = peak_sleep * 60       # 10 minutes in seconds during peak business hours
         self.offpeak_sleep = offpeak_sleep * 60 # 60 minutes in seconds during off hours
         self.max_stale = max_stale * 60         # 24 hours in seconds force refresh
+        self.conn = None                        # Persistent SOURCE connection
+        self.conn_address = None
+        self.fingerprints = {}                  # News URN -> fingerprint of the source fields last stored
+        self.source_digest = None               # Digest of the SOURCE response just read
+        self.last_digest = None                 # Digest of the SOURCE response last stored
+        self.last_stored = None
+        self.last_refresh = None                # When every item was last diffed without fingerprints
         default_file = 'file:./news.json'
 
         # Verify arguments and parse compound arguments
@@ -180,6 +211,8 @@ class Router():
         self.NEWSURNPREFIX = self.PUBLISHER.NewsURNPrefix or self.config.get('NEWSURNPREFIX', ['NONE'])  # Default to NONE
         self.INPUTURNPREFIX = self.config.get('INPUTURNPREFIX', 'NONE')  # Default to NONE
         self.PUBLISHERNAME = self.PUBLISHER.OrganizationName
+        # Postgres COPY is much faster than INSERT VALUES for large batches
+        self.BULK_LOAD = bool(bulk_insert_models) and connection.vendor == 'postgresql'
         
         if self.args.daemonaction == 'start':
             if self.src['scheme'] not in ['http', 'https'] or self.dest['scheme'] not in ['warehouse']:
@@ -193,6 +226,29 @@ class Router():
         self.logger.info('Publisher: {} ({})'.format(self.PUBLISHERNAME, self.ORGANIZATIONID))
         self.logger.info('NewsURNPrefix: ' + self.NEWSURNPREFIX)
         self.logger.info('InputURNPrefix: ' + self.INPUTURNPREFIX)
+        self.logger.info('Bulk load: ' + ('COPY' if self.BULK_LOAD else 'INSERT'))
+
+        # Adaptive polling is enabled by a daily poll budget, see smart_sleep
+        self.POLL_BUDGET = self.config.get('POLL_DAILY_BUDGET')
+        if self.POLL_BUDGET is not None and (type(self.POLL_BUDGET) is not int or self.POLL_BUDGET < 1):
+            self.logger.error('POLL_DAILY_BUDGET must be a positive integer number of polls per day')
+            sys.exit(1)
+        # Cold start hourly (Central) profile of when outages change, defaults to the peak/offpeak schedule
+        self.POLL_PROFILE = self.config.get('POLL_PROFILE') or \
+            [1 / (self.peak_sleep if 6 <= hour <= 21 else self.offpeak_sleep) for hour in range(24)]
+        if type(self.POLL_PROFILE) is not list or len(self.POLL_PROFILE) != 24 or \
+                any(type(weight) not in (int, float) or weight < 0 for weight in self.POLL_PROFILE) or \
+                not sum(self.POLL_PROFILE):
+            self.logger.error('POLL_PROFILE must be a list of 24 non-negative hourly weights')
+            sys.exit(1)
+        history_size = self.config.get('POLL_HISTORY', 500)
+        if type(history_size) is not int or history_size < 1:
+            self.logger.error('POLL_HISTORY must be a positive integer number of polls')
+            sys.exit(1)
+        self.poll_history = deque(maxlen=history_size)  # (previous poll, poll, changed)
+        self.last_poll = None
+        if self.POLL_BUDGET:
+            self.logger.info('Polling: adaptive, {}/day'.format(self.POLL_BUDGET))
 
     def SaveDaemonStdOut(self, path):
         # Save daemon log file using timestamp only if it has anything unexpected in it
@@ -200,7 +256,7 @@ class Router():
             file = open(path, 'r')
             lines = file.read()
             file.close()
-            if not re.match("^started with pid \d+$", lines) and not re.match("^$", lines):
+            if not Started_RE.match(lines) and not Empty_RE.match(lines):
                 ts = datetime.strftime(datetime.now(), '%Y-%m-%d_%H:%M:%S')
                 newpath = '{}.{}'.format(path, ts)
                 self.logger.debug('Saving previous daemon stdout to {}'.format(newpath))
@@ -233,23 +289,67 @@ class Router():
         if not port:
             port = '80' if urlp.scheme == 'http' else '443'     # Default is HTTPS/443
         
-        headers = {'Content-type': 'application/json'
+        headers = {'Content-type': 'application/json',
+                   'Connection': 'keep-alive',
+                   'Accept-Encoding': 'gzip'
             }
-#        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        # Reuse the connection across daemon polls to skip the TCP and TLS handshakes
+        if self.conn and self.conn_address != (host, port):
+            self.conn.close()
+            self.conn = None
+        for attempt in (1, 2):
+            if not self.conn:
+#                ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
 #   2023-02-16 JP - figure out later the appropriate level of ssl verification
-        ctx = ssl._create_unverified_context()
-        conn = httplib.HTTPSConnection(host=host, port=port, context=ctx)
-        conn.request('GET', urlp.path, None , headers)
-        self.logger.debug('HTTP GET  {}'.format(url))
-        response = conn.getresponse()
-        result = response.read()
-        self.logger.debug('HTTP RESP {} {} (returned {}/bytes)'.format(response.status, response.reason, len(result)))
+                ctx = ssl._create_unverified_context()
+                # Timeout so a connection silently dropped while idle fails instead of blocking
+                self.conn = httplib.HTTPSConnection(host=host, port=port, context=ctx, timeout=60)
+                self.conn_address = (host, port)
+            try:
+                self.conn.request('GET', urlp.path, None , headers)
+                self.logger.debug('HTTP GET  {}'.format(url))
+                response = self.conn.getresponse()
+                break
+            except (httplib.HTTPException, OSError) as e:     # Includes timeouts and SSL errors
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+                # The server probably closed the idle connection, reconnect once
+                self.logger.debug('HTTP reconnect after {}: {}'.format(type(e).__name__, e))
+        self.logger.debug('HTTP RESP {} {} (encoding={})'.format(response.status, response.reason, response.getheader('Content-Encoding', 'identity')))
+        if response.status != 200:  # Error bodies aren't outages, don't reuse the connection either
+            self.logger.error('SOURCE returned HTTP {} {}'.format(response.status, response.reason))
+            self.conn.close()
+            self.conn = None
+            return(None)
+        self.source_digest = None               # Set once the response has been read completely
+        return(self.Stream_SOURCE(response))
+
+    def Stream_SOURCE(self, response):
+        # Yield outages as they are parsed so they can be processed while the rest of the body arrives
+        if response.getheader('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=response)  # Decompresses as it is read
+        else:
+            body = response
+        reader = DigestReader(body)
         try:
-            input_json = json.loads(result)
-        except ValueError as e:
+            for p_res in ijson.items(reader, 'item', use_float=True):
+                yield p_res
+            self.source_digest = reader.hash.digest()
+        except ijson.JSONError as e:
             self.logger.error('Response not in expected JSON format ({})'.format(e))
-            return(None)
-        return(input_json)
+            raise ValueError('Response not in expected JSON format ({})'.format(e))
+        except (gzip.BadGzipFile, EOFError, zlib.error) as e:   # Bad header, truncated, corrupt data
+            self.logger.error('Response not in expected gzip format ({})'.format(e))
+            raise ValueError('Response not in expected gzip format ({})'.format(e))
+        except OSError as e:        # Timeout or connection lost while streaming
+            self.logger.error('Response could not be read ({}: {})'.format(type(e).__name__, e))
+            raise ValueError('Response could not be read ({}: {})'.format(type(e).__name__, e))
+        finally:
+            if not response.isclosed() and self.conn:   # Not read to the end, the connection can't be reused
+                self.conn.close()
+                self.conn = None
 
     def Analyze_SOURCE(self, input_obj):
         maxlen = {}
@@ -258,19 +358,43 @@ class Router():
             self.logger.info('Item={}, Affected={}, StartDatetime="{}"'.format(p_res['view_node'], len(p_res['affected_infrastructure_elements']), p_res['start_timestamp'], p_res['resource_descriptive_name']))
 
     def Write_Cache(self, file, input_obj):
-        data = json.dumps(input_obj)
-        with open(file, 'w') as my_file:
-            my_file.write(data)
-            my_file.close()
-        self.logger.info('Serialized and wrote {} bytes to file={}'.format(len(data), file))
-        return(len(data))
+        # Serialize one record at a time so neither the records nor the whole document are held in memory
+        # Write to a temporary file so a source error part way through leaves the previous cache intact
+        size = 0
+        records = 0
+        tmp_file = file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as my_file:
+                size += my_file.write(b'[')
+                for p_res in input_obj:
+                    if records:
+                        size += my_file.write(b',')
+                    size += my_file.write(orjson.dumps(p_res))
+                    records += 1
+                size += my_file.write(b']')
+                my_file.close()
+            if not records:     # An empty or non-array source is not a valid cache
+                os.remove(tmp_file)
+                self.logger.error('Source returned no outage records, not replacing file={}'.format(file))
+                return(0)
+            os.replace(tmp_file, file)
+        except ValueError as e: # The source stream failed, it already logged why
+            os.remove(tmp_file)
+            self.logger.error('{} reading outages, not replacing file={}: {}'.format(type(e).__name__, file, e))
+            return(0)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        self.logger.info('Serialized and wrote {} bytes to file={}'.format(size, file))
+        return(size)
 
     def Read_Cache(self, file):
-        with open(file, 'r') as my_file:
+        with open(file, 'rb') as my_file:
             data = my_file.read()
             my_file.close()
         try:
-            input_obj = json.loads(data)
+            input_obj = orjson.loads(data)
             self.logger.info('Read and parsed {} bytes from file={}'.format(len(data), file))
             return(input_obj)
         except ValueError as e:
@@ -278,31 +402,63 @@ class Router():
             sys.exit(1)
 
     def Warehouse_XSEDE_News(self, input_obj):
+        # Merges an outage for multiple resources into one, consuming input_obj as it is parsed
+        merged_obj = {}                 # The first record for each outage
+        affected = defaultdict(list)    # The resources affected by each outage
+        (prefix, prefix_len) = (self.INPUTURNPREFIX, len(self.INPUTURNPREFIX))
+        records = 0                     # Before filtering, an empty or non-array feed would delete everything
+        try:
+            for p_res in input_obj:
+                records += 1
+                # Filter out new ACCESS outages and processes only legacy XSEDE ones
+                if p_res['ID'][:prefix_len] != prefix:
+                    continue
+                URN = '{}{}'.format(self.NEWSURNPREFIX, p_res['OutageID'])
+                affected[URN].append(p_res['ResourceID'])
+                merged_obj.setdefault(URN, p_res)
+        except ValueError as e:     # Nothing has been written yet
+            msg = '{} reading outages: {}'.format(type(e).__name__, e)
+            return(False, msg)
+        if not records:
+            msg = 'Source returned no outage records, not changing the warehouse'
+            self.logger.error(msg)
+            return(False, msg)
+        for (URN, p_res) in merged_obj.items():
+            p_res.pop('ResourceID', None)
+            p_res['AffectedInfrastructure'] = affected[URN]
+
+        # The feed rarely changes between daemon polls, skip it unless a full refresh (see below) is due
+        if self.source_digest and self.source_digest == self.last_digest and self.last_refresh and \
+                (self.start - self.last_refresh).total_seconds() < self.max_stale:
+            self.logger.info('Source unchanged since {:%Y-%m-%d %H:%M:%S}, skipping'.format(self.last_stored))
+            self.STATS.update({'Skip': len(merged_obj)})
+            return(True, '')
+
         self.cur = {}   # Current items
         self.new = {}   # New items
-        for item in News.objects.filter(URN__startswith=self.NEWSURNPREFIX):
+        # Only load the fields we compare and update, streaming rows instead of caching the whole queryset
+        # The URN prefix match needs the pattern index in sql/news_urn_prefix_index.sql to avoid a scan
+        for item in News.objects.filter(URN__startswith=self.NEWSURNPREFIX).only('URN', 'Subject', 'Content', \
+                'NewsStart', 'NewsEnd', 'NewsType', 'DistributionOptions', 'WebURL', 'Affiliation', 'Publisher') \
+                .iterator(chunk_size=2000):
             self.cur[item.URN] = item
 
-        self.cur_assoc = {} # Current associations
+        self.cur_assoc = {} # Current associations by (URN, type, id), value is the association id
         self.new_assoc = {} # New associations
-        for item in News_Associations.objects.filter(NewsItem__URN__startswith=self.NEWSURNPREFIX):
-            KEY = str(item)
-            self.cur_assoc[KEY] = item
-
-        # Merges an outage for multiple resources into one
-        merged_obj = {}
-        for p_res in input_obj:
-            # Filter out new ACCESS outages and processes only legacy XSEDE ones
-            if not p_res['ID'].startswith(self.INPUTURNPREFIX):
-                continue
-            URN = '{}{}'.format(self.NEWSURNPREFIX, p_res['OutageID'])
-            RESOURCE = p_res['ResourceID']
-            if URN not in merged_obj:
-                merged_obj[URN] = p_res
-                merged_obj[URN].pop('ResourceID', None)
-                merged_obj[URN]['AffectedInfrastructure'] = []
-            merged_obj[URN]['AffectedInfrastructure'].append(RESOURCE)
-            
+        # Plain tuples from the association table, the NewsItem foreign key column already holds the News URN
+        for (assoc_pk, URN, assoc_type, assoc_id) in News_Associations.objects.filter( \
+                NewsItem__URN__startswith=self.NEWSURNPREFIX).values_list('id', 'NewsItem_id', 'AssociatedType', 'AssociatedID') \
+                .iterator(chunk_size=2000):
+            self.cur_assoc[(URN, assoc_type, assoc_id)] = assoc_pk
+
+        to_create = []  # News items not in the warehouse
+        to_update = []  # News items in the warehouse that changed
+        fingerprints = {}
+        # Fingerprints only cover what this process stored, re-diff every field after max_stale to catch other changes
+        refresh = not self.last_refresh or (self.start - self.last_refresh).total_seconds() >= self.max_stale
+        if refresh:
+            self.logger.info('Full refresh, comparing every item with the warehouse')
+        datetimes = {}  # Timestamp -> parsed datetime, outages share maintenance windows
         for (URN, p_res) in merged_obj.items():
             if p_res['OutageType'] == 'Reconfiguration':
                 TYPE = 'Reconfiguration'
@@ -310,73 +466,167 @@ class Router():
                 TYPE = 'Outage Partial'
             else:
                 TYPE = 'Outage Full'
+            fingerprint = hashlib.blake2b(orjson.dumps([p_res['Subject'], p_res['Content'], \
+                p_res['OutageStart'], p_res['OutageEnd'], TYPE]), digest_size=16).digest()
+            fingerprints[URN] = fingerprint
+            if not refresh and URN in self.cur and self.fingerprints.get(URN) == fingerprint:
+                # Stored by an earlier run of this process and unchanged since, skip parsing and comparing
+                self.new[URN] = self.cur[URN]
+                self.STATS.update({'Skip'})
+                continue
             WEBURL = 'https://operations-api.access-ci.org/wh2/news/v1/id/{}/?format=html'.format(URN)
-            try:
-                news_item, created = News.objects.update_or_create(
-                                    URN = URN,
-                                    defaults = {
-                                        'Subject': p_res['Subject'],
-                                        'Content': p_res['Content'],
-                                        'NewsStart': parse_datetime(p_res['OutageStart']),
-                                        'NewsEnd': parse_datetime(p_res['OutageEnd']),
-                                        'NewsType': TYPE,
-                                        'DistributionOptions': None,
-                                        'WebURL': WEBURL,
-                                        'Affiliation': self.AFFILIATION,
-                                        'Publisher':  self.PUBLISHER
-                                     })
-                news_item.save()
-                self.new[URN] = news_item
+            for value in (p_res['OutageStart'], p_res['OutageEnd']):
+                if value not in datetimes:
+                    datetimes[value] = parse_datetime(value)
+            fields = {
+                'Subject': p_res['Subject'],
+                'Content': p_res['Content'],
+                'NewsStart': datetimes[p_res['OutageStart']],
+                'NewsEnd': datetimes[p_res['OutageEnd']],
+                'NewsType': TYPE,
+                'DistributionOptions': None,
+                'WebURL': WEBURL,
+                'Affiliation': self.AFFILIATION,
+                'Publisher_id': self.PUBLISHER.pk     # The id avoids fetching the current Publisher
+            }
+            if URN in self.cur:
+                news_item = self.cur[URN]
+                changed = False
+                for (field, value) in fields.items():
+                    if getattr(news_item, field) != value:
+                        setattr(news_item, field, value)
+                        changed = True
+                if changed:
+                    to_update.append(news_item)
+                    self.STATS.update({'Update'})
+                else:
+                    self.STATS.update({'Skip'})
+            else:
+                news_item = News(URN=URN, **fields)
+                to_create.append(news_item)
                 self.STATS.update({'Update'})
-                self.logger.debug('News URN={}'.format(URN))
-            except (DataError, IntegrityError) as e:
-                msg = '{} saving News URN={} ({}): {}'.format(type(e).__name__, URN, e.message)
-                self.logger.error(msg)
-                return(False, msg)
-        
+            self.new[URN] = news_item
+            self.logger.debug('News URN={}'.format(URN))
+
+        new_assocs = [] # Associations not in the warehouse
+        for (URN, p_res) in merged_obj.items():
+            news_item = self.new[URN]
             for resource in p_res['AffectedInfrastructure']:
-                try:
-                    assoc_type = 'Resource'
-                    assoc_id = resource
-                    KEY = '{}->{}/{}'.format(URN, assoc_type, assoc_id) # Identical to str(News_Association item)
-                    if KEY in self.cur_assoc:   # Already exists
-                        self.new_assoc[KEY] = self.cur_assoc[KEY]
-                        continue
-                    associated_item = News_Associations(
-                        NewsItem = news_item,
-                        AssociatedType = assoc_type,
-                        AssociatedID = assoc_id)
-                    associated_item.save()
-                    self.new_assoc[KEY]=associated_item
-                    self.logger.debug('Assoc KEY={}'.format(KEY))
-                except (DataError, IntegrityError) as e:
-                    msg = '{} saving Assoc KEY={} ({}): {}'.format(type(e).__name__, KEY, e.message)
-                    self.logger.error(msg)
-                    return(False, msg)
-
-        # Delete obsolete associations
-        for KEY in self.cur_assoc:
-            if KEY not in self.new_assoc:
-                try:
-                    News_Associations.objects.get(pk=self.cur_assoc[KEY].id).delete()
-                    self.logger.info('Deleted Assoc KEY={}'.format(KEY))
-                except (DataError, IntegrityError) as e:
-                    self.logger.error('{} deleting Assoc KEY={}: {}'.format(type(e).__name__, KEY, e.message))
-
-        # Delete obsolete new items
-        for URN in self.cur:
-            if URN not in self.new:
-                try:
-                    News.objects.filter(URN=URN).delete()
-                    self.STATS.update({'Delete'})
-                    self.logger.info('Deleted News URN={}'.format(URN))
-                except (DataError, IntegrityError) as e:
-                    self.logger.error('{} deleting News URN={}: {}'.format(type(e).__name__, URN, e.message))
+                assoc_type = 'Resource'
+                assoc_id = resource
+                KEY = (URN, assoc_type, assoc_id)   # Formatted like str(News_Association item) only for logging
+                if KEY in self.cur_assoc:   # Already exists
+                    self.new_assoc[KEY] = self.cur_assoc[KEY]
+                    continue
+                associated_item = News_Associations(
+                    NewsItem = news_item,
+                    AssociatedType = assoc_type,
+                    AssociatedID = assoc_id)
+                new_assocs.append(associated_item)
+                self.new_assoc[KEY]=associated_item
+                self.logger.debug('Assoc KEY=%s->%s/%s', *KEY)
+
+        obsolete_keys = [KEY for KEY in self.cur_assoc if KEY not in self.new_assoc]
+        obsolete_urns = [URN for URN in self.cur if URN not in self.new]
+
+        # All writes commit together, or roll back together on any error
+        try:
+            with transaction.atomic(savepoint=False):
+                news_update_fields = ['Subject', 'Content', 'NewsStart', 'NewsEnd', 'NewsType', \
+                                      'DistributionOptions', 'WebURL', 'Affiliation', 'Publisher']
+                if self.BULK_LOAD:
+                    # COPY into a temporary table followed by one INSERT/UPDATE from it
+                    if to_create:
+                        bulk_insert_models(to_create)
+                    if to_update:
+                        bulk_update_models(to_update, update_field_names=news_update_fields)
+                    if new_assocs:
+                        bulk_insert_models(new_assocs, ignore_conflicts=True)
+                else:
+                    # One batched INSERT for new items and one batched UPDATE for changed items
+                    News.objects.bulk_create(to_create, batch_size=500)
+                    News.objects.bulk_update(to_update, fields=news_update_fields, batch_size=500)
+                    News_Associations.objects.bulk_create(new_assocs, batch_size=1000, ignore_conflicts=True)
+                # Delete obsolete associations
+                if obsolete_keys:
+                    News_Associations.objects.filter(pk__in=[self.cur_assoc[KEY] for KEY in obsolete_keys]).delete()
+                # Delete obsolete new items
+                if obsolete_urns:
+                    News.objects.filter(URN__in=obsolete_urns).delete()
+        except (DataError, IntegrityError) as e:
+            msg = '{} saving News: {}'.format(type(e).__name__, e)
+            self.logger.error(msg)
+            return(False, msg)
+
+        self.fingerprints = fingerprints
+        if refresh:
+            self.last_refresh = self.start
+        (self.last_digest, self.last_stored) = (self.source_digest, self.start)
+        for KEY in obsolete_keys:
+            self.logger.info('Deleted Assoc KEY=%s->%s/%s', *KEY)
+        for URN in obsolete_urns:
+            self.logger.info('Deleted News URN={}'.format(URN))
+        self.STATS.update({'Delete': len(obsolete_urns), 'AssocUpdate': len(new_assocs), 'AssocDelete': len(obsolete_keys)})
         return(True, '')
             
+    def Poll_Density(self):
+        # Hourly (Central) density of when outages change, the configured profile blended with observed changes
+        total = sum(self.POLL_PROFILE)
+        density = [weight / total for weight in self.POLL_PROFILE]
+        changes = [0] * 24
+        for (prev_poll, poll, changed) in self.poll_history:
+            if changed:     # Happened sometime after the previous poll, use the midpoint
+                changes[(prev_poll + (poll - prev_poll) / 2).astimezone(Central_TZ).hour] += 1
+        observed = sum(changes)
+        if observed:
+            blend = observed / (observed + 10)  # Trust observations more as they accumulate
+            density = [(1 - blend) * density[hour] + blend * changes[hour] / observed for hour in range(24)]
+        # Keep every hour polled at least occasionally
+        return([max(value, 0.001 / 24) for value in density])
+
+    def Poll_Schedule(self, density, budget):
+        # Poll hours in [0, 24) minimizing expected detection delay for density p(t) and budget polls/day:
+        #   L(i) = L(i-1) + integral(p, L(i-2), L(i-1)) / p(L(i-1))
+        # The first poll L(1) is found by bisection so that the day holds budget polls
+        def integral(start, end):
+            total = 0.0
+            while start < end:
+                edge = min(math.floor(start) + 1, end)
+                total += density[int(start) % 24] * (edge - start)
+                start = edge
+            return(total)
+
+        def schedule(first):
+            times = [0.0, first]
+            while len(times) <= budget:
+                (prev, last) = times[-2:]
+                following = last + integral(prev, last) / density[int(last) % 24]
+                if following >= 24:
+                    break
+                times.append(following)
+            return(times)
+
+        (low, high) = (0.0, 24.0)
+        for _ in range(50):
+            middle = (low + high) / 2
+            if len(schedule(middle)) > budget:
+                low = middle
+            else:
+                high = middle
+        return(schedule(high))
+
     def smart_sleep(self, last_run):
-        # Between 6 AM and 9 PM Central
-        current_sleep = self.peak_sleep if 6 <= datetime.now(Central_TZ).hour <= 21 else self.offpeak_sleep
+        if self.POLL_BUDGET:
+            now = datetime.now(Central_TZ)
+            hour = now.hour + now.minute / 60 + now.second / 3600
+            density = self.Poll_Density()
+            self.logger.debug('Poll density: {}'.format(', '.join('{:.4f}'.format(value) for value in density)))
+            times = self.Poll_Schedule(density, self.POLL_BUDGET)
+            next_poll = next((when for when in times if when > hour), times[0] + 24)
+            current_sleep = min(max((next_poll - hour) * 3600, 60), self.max_stale)
+        else:
+            # Between 6 AM and 9 PM Central
+            current_sleep = self.peak_sleep if 6 <= datetime.now(Central_TZ).hour <= 21 else self.offpeak_sleep
         self.logger.debug('sleep({})'.format(current_sleep))
         sleep(current_sleep)
 
@@ -410,8 +660,12 @@ class Router():
                 if self.dest['scheme'] == 'warehouse':
                     if rc:  # No errors
                         pa.FinishActivity(rc, summary_msg)
+                        # Whether anything changed since the previous poll feeds adaptive polling
+                        self.poll_history.append((self.last_poll or self.start, self.start, \
+                            any(self.STATS[stat] for stat in ('Update', 'Delete', 'AssocUpdate', 'AssocDelete'))))
                     else:   # Something failed, use returned message
                         pa.FinishActivity(rc, warehouse_msg)
+            self.last_poll = self.start
             if not self.args.daemonaction:
                 break
             self.smart_sleep(self.start)
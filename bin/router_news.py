@@ -19,8 +19,11 @@ import ssl
 from time import sleep
 import traceback
 from urllib.parse import urlparse
-import pytz
-Central_TZ = pytz.timezone('US/Central')
+from zoneinfo import ZoneInfo
+Central_TZ = ZoneInfo('America/Chicago')    # US/Central
+# Expected daemon stdout contents, see SaveDaemonStdOut
+Started_RE = re.compile(r'^started with pid \d+$')
+Empty_RE = re.compile(r'^$')
 
 import django
 django.setup()
@@ -193,7 +196,7 @@ class Router():
             file = open(path, 'r')
             lines = file.read()
             file.close()
-            if not re.match("^started with pid \d+$", lines) and not re.match("^$", lines):
+            if not Started_RE.match(lines) and not Empty_RE.match(lines):
                 ts = datetime.strftime(datetime.now(), '%Y-%m-%d_%H:%M:%S')
                 newpath = '{}.{}'.format(path, ts)
                 self.logger.debug('Saving previous daemon stdout to {}'.format(newpath))
@@ -0,0 +1,13 @@
+--
+--  Pattern indexes for the URN prefix (LIKE 'prefix%') queries in bin/convert_from_xsede.py
+--
+--  The News models and migrations are owned by Operations_Warehouse_Django, this belongs there as a
+--  migration (models.Index(..., opclasses=['varchar_pattern_ops'])). Until then apply it by hand.
+--  Table names assume the Django defaults for the news app, adjust if the models set db_table.
+--  A plain btree index can't serve LIKE prefix matches unless the database uses the C collation.
+--
+CREATE INDEX CONCURRENTLY IF NOT EXISTS news_news_urn_prefix_idx
+    ON news_news ("URN" varchar_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS news_news_associations_newsitem_prefix_idx
+    ON news_news_associations ("NewsItem_id" varchar_pattern_ops);